@@ -63,10 +63,10 @@ def remove_null_items(d):
     """Recursively removes all (key,value) pairs from d where the
        value is None"""
     null_keys = []
-    for key in d.keys():
-        if type(d[key]) == dict:
-            remove_null_items(d[key])
-        elif d[key] is None:
+    for key, value in d.items():
+        if type(value) == dict:
+            remove_null_items(value)
+        elif value is None:
             null_keys.append(key)
     for k in null_keys:
         del d[k]
@@ -159,8 +159,13 @@ def _find_child_el(element, id):
        Raises a DataNotFoundError if the element at id could not be
        found.
     """
+    if '[' not in id and ']' not in id:
+        # No list indices, which is the common case; skip parsing them
+        if type(element) == dict and id in element:
+            return element[id]
+        raise DataNotFoundError(id + " in " + str(element))
     id, list_indices = split_identifier_list_indices(id)
-    if type(element) == dict and id in element.keys():
+    if type(element) == dict and id in element:
         result = element[id]
     else:
         raise DataNotFoundError(id + " in " + str(element))
@@ -20,13 +20,13 @@
 """
 
 import bundy
-import signal
-import ast
-import os
 import copy
+import os
+import re
 import tempfile
 import json
-import errno
+import mmap
+import threading
 from bundy.cc import data
 from bundy.cc.proto_defs import *
 from bundy.config import ccsession, config_data, module_spec
@@ -35,8 +35,98 @@ import bundy_config
 import bundy.log
 from bundy.log_messages.cfgmgr_messages import *
 
+# orjson is considerably faster than the standard json module for both
+# parsing and serializing the configuration database, and pysimdjson is
+# faster still for parsing. Use whichever is available. Both helpers
+# work on UTF-8 encoded data; _json_loads() takes any object supporting
+# the buffer protocol (like bytes or mmap), _json_dumps() returns bytes.
+# Whatever the fast modules can't represent exactly is left to the
+# standard module, so the results are always the same as with json.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+# Integers beyond 64 bits have at least this many digits. The fast parsers
+# can't represent them (orjson even silently turns them into floats), so
+# documents that might contain them go to the standard module.
+_LONG_NUMBER_RE = re.compile(rb'[0-9]{19}')
+
+def _std_json_loads(raw):
+    return json.loads(str(raw, 'utf-8'))
+
+def _std_json_dumps(value):
+    return json.dumps(value).encode('utf-8')
+
+if orjson is not None:
+    def _orjson_loads(raw):
+        if _LONG_NUMBER_RE.search(raw) is not None:
+            return _std_json_loads(raw)
+        try:
+            # orjson doesn't take arbitrary buffers, but does take a view
+            # on them. Release it right away so the buffer can be closed.
+            with memoryview(raw) as view:
+                return orjson.loads(view)
+        except ValueError:
+            # NaN, Infinity and numbers out of the range of a double are
+            # rejected by orjson, but accepted by the standard module
+            # (which raises ValueError itself if the data is really broken)
+            return _std_json_loads(raw)
+
+    def _orjson_dumps(value):
+        try:
+            payload = orjson.dumps(value)
+        except orjson.JSONEncodeError:
+            # Integers beyond 64 bits, keys that aren't strings, ...
+            return _std_json_dumps(value)
+        # orjson writes NaN and infinities as null; as we can't tell those
+        # from None, leave anything with a null in it to the standard module
+        if b'null' in payload:
+            return _std_json_dumps(value)
+        return payload
+
+if simdjson is not None:
+    # The parser reuses its internal buffers between documents, so keep
+    # a single one around. It must not be used by two threads at once.
+    _json_parser = simdjson.Parser()
+    _json_parser_lock = threading.Lock()
+
+    def _simdjson_loads(raw):
+        if _LONG_NUMBER_RE.search(raw) is not None:
+            return _std_json_loads(raw)
+        try:
+            with _json_parser_lock:
+                # recursive=True converts the document into plain dicts
+                # and lists, so nothing refers to the parser once it is
+                # reused.
+                return _json_parser.parse(raw, recursive=True)
+        except (ValueError, RuntimeError):
+            # As with orjson: NaN, Infinity and numbers pysimdjson can't
+            # represent (it raises RuntimeError for some big integers)
+            # are left to the standard module
+            return _std_json_loads(raw)
+
+    _json_loads = _simdjson_loads
+elif orjson is not None:
+    _json_loads = _orjson_loads
+else:
+    _json_loads = _std_json_loads
+
+if orjson is not None:
+    _json_dumps = _orjson_dumps
+else:
+    _json_dumps = _std_json_dumps
+
 logger = bundy.log.Logger("cfgmgr", buffer=True)
 
+# Matches the numeric suffix of backup file names, as in "<file>.bak.3"
+_BACKUP_SUFFIX_RE = re.compile(r'\.([0-9]+)$')
+
 class ConfigManagerDataReadError(Exception):
     """This exception is thrown when there is an error while reading
        the current configuration on startup."""
@@ -62,6 +152,8 @@ class ConfigManagerData:
            """
         self.data = {}
         self.data['version'] = config_data.BUNDY_CONFIG_DATA_VERSION
+        # What write_to_file() last put in db_filename, if anything
+        self._last_written = None
         if os.path.isabs(file_name):
             self.db_filename = file_name
             self.data_path = os.path.dirname(file_name)
@@ -75,34 +167,36 @@ class ConfigManagerData:
         check whether it needs updating due to version changes.
         Return the data with updates (or the original data if no
         updates were necessary).
-        Even though it is at this moment not technically necessary, this
-        function makes and returns a copy of the given data.
+        If updates are applied, the given data itself is left untouched;
+        a shallow copy with the changed top-level entries is returned.
+        Nested values are shared between the given and returned data.
         """
-        config = copy.deepcopy(file_config)
-        if 'version' in config:
-            data_version = config['version']
+        if 'version' in file_config:
+            data_version = file_config['version']
         else:
             # If it is not present, assume latest or earliest?
             data_version = 1
 
         # For efficiency, if up-to-date, return now
         if data_version == config_data.BUNDY_CONFIG_DATA_VERSION:
-            return config
+            return file_config
 
         # Don't know what to do if it is more recent
         if data_version > config_data.BUNDY_CONFIG_DATA_VERSION:
             raise ConfigManagerDataReadError(
                       "Cannot load configuration file: version "
-                      "%d not yet supported" % config['version'])
+                      "%d not yet supported" % data_version)
 
         # At some point we might give up supporting older versions
         if data_version < 1:
             raise ConfigManagerDataReadError(
                       "Cannot load configuration file: version "
-                      "%d no longer supported" % config['version'])
+                      "%d no longer supported" % data_version)
 
         # Ok, so we have a still-supported older version. Apply all
-        # updates
+        # updates. None of them modifies anything below the top level,
+        # so a shallow copy is enough to keep file_config intact.
+        config = dict(file_config)
         new_data_version = data_version
         if new_data_version == 1:
             # only format change, no other changes necessary
@@ -141,20 +235,24 @@ class ConfigManagerData:
         logger.info(CFGMGR_CONFIG_FILE, config.db_filename)
         file = None
         try:
-            file = open(config.db_filename, 'r')
-            file_config = json.loads(file.read())
+            file = open(config.db_filename, 'rb')
+            # Parse the file through a memory map, rather than reading it
+            # into a bytes object first, to save a copy of all the data.
+            # (mmap refuses empty files with a ValueError, which is fine,
+            # that is not a valid configuration either.)
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                file_config = _json_loads(buf)
             # handle different versions here
             # If possible, we automatically convert to the new
             # scheme and update the configuration
             # If not, we raise an exception
             config.data = ConfigManagerData.check_for_updates(file_config)
+        except FileNotFoundError:
+            # if the file is not there, then continue (raise empty),
+            # any other error is fatal (raise error)
+            raise ConfigManagerDataEmpty("No configuration file found")
         except IOError as ioe:
-            # if IOError is 'no such file or directory', then continue
-            # (raise empty), otherwise fail (raise error)
-            if ioe.errno == errno.ENOENT:
-                raise ConfigManagerDataEmpty("No configuration file found")
-            else:
-                raise ConfigManagerDataReadError("Can't read configuration file: " + str(ioe))
+            raise ConfigManagerDataReadError("Can't read configuration file: " + str(ioe))
         except ValueError:
             raise ConfigManagerDataReadError("Configuration file out of date or corrupt, please update or remove " + config.db_filename)
         finally:
@@ -165,32 +263,63 @@ class ConfigManagerData:
     def write_to_file(self, output_file_name = None):
         """Writes the current configuration data to a file. If
            output_file_name is not specified, the file used in
-           read_from_file is used."""
+           read_from_file is used.
+
+           The data is written to a temporary file first, which is synced
+           to disk and then atomically moved over the target file, so the
+           target always holds either the old or the new configuration.
+
+           If output_file_name is not specified and the data is the same
+           as what this function wrote the last time, nothing is done.
+           """
         filename = None
+        renamed = False
+        payload = _json_dumps(self.data)
+        if output_file_name is None and payload == self._last_written:
+            return
 
         try:
-            file = tempfile.NamedTemporaryFile(mode='w',
+            file = tempfile.NamedTemporaryFile(mode='wb',
                                                prefix="bundy-config.db.",
                                                dir=self.data_path,
                                                delete=False)
             filename = file.name
-            file.write(json.dumps(self.data))
-            file.write("\n")
+            file.write(payload)
+            file.write(b"\n")
+            file.flush()
+            os.fsync(file.fileno())
             file.close()
             if output_file_name:
-                os.rename(filename, output_file_name)
+                target = output_file_name
             else:
-                os.rename(filename, self.db_filename)
+                target = self.db_filename
+            os.replace(filename, target)
+            renamed = True
+            if output_file_name is None:
+                self._last_written = payload
         except IOError as ioe:
             logger.error(CFGMGR_IOERROR_WHILE_WRITING_CONFIGURATION, ioe)
         except OSError as ose:
             logger.error(CFGMGR_OSERROR_WHILE_WRITING_CONFIGURATION, ose)
-        try:
-            if filename and os.path.exists(filename):
+        if renamed:
+            # Make sure the rename itself is on disk as well. The new
+            # configuration is in place already, so failing here only
+            # means it might not survive a crash.
+            dir_name = os.path.dirname(target) or os.curdir
+            try:
+                dir_fd = os.open(dir_name, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+            except OSError as ose:
+                logger.warn(CFGMGR_SYNC_CONFIG_DIRECTORY_FAILED, dir_name, ose)
+        if filename and not renamed:
+            try:
                 os.remove(filename)
-        except OSError:
-            # Ok if we really can't delete it anymore, leave it
-            pass
+            except OSError:
+                # Ok if we really can't delete it anymore, leave it
+                pass
 
     def rename_config_file(self, old_file_name=None, new_file_name=None):
         """Renames the given configuration file to the given new file name,
@@ -198,25 +327,58 @@ class ConfigManagerData:
            If old_file_name is None (default), the file used in
            read_from_file is used. If new_file_name is None (default), the
            file old_file_name appended with .bak is used. If that file exists
-           already, .1 is appended. If that file exists, .2 is appended, etc.
+           already, .1 is appended. If that file exists too, the suffix
+           is one higher than the highest one already in use (.2, .3, etc.)
         """
         if old_file_name is None:
             old_file_name = self.db_filename
         if new_file_name is None:
             new_file_name = old_file_name + ".bak"
+        if not os.path.exists(old_file_name):
+            return
+        if old_file_name == self.db_filename:
+            # It's gone now, so make sure write_to_file() recreates it
+            self._last_written = None
+        reserved = False
         if os.path.exists(new_file_name):
-            i = 1
-            while os.path.exists(new_file_name + "." + str(i)):
-                i += 1
-            new_file_name = new_file_name + "." + str(i)
-        if os.path.exists(old_file_name):
-            logger.info(CFGMGR_BACKED_UP_CONFIG_FILE, old_file_name, new_file_name)
+            new_file_name = self.__reserve_backup_file_name(new_file_name)
+            reserved = True
+        logger.info(CFGMGR_BACKED_UP_CONFIG_FILE, old_file_name, new_file_name)
+        try:
             os.rename(old_file_name, new_file_name)
+        except OSError:
+            # Don't leave the empty placeholder behind
+            if reserved:
+                os.remove(new_file_name)
+            raise
+
+    def __reserve_backup_file_name(self, file_name):
+        """Private function that returns file_name with a numeric suffix
+           (.1, .2, etc.) one higher than the highest one already in use.
+           The directory is scanned only once, and the chosen file is
+           created (empty) exclusively, so two managers can't pick the
+           same name; the caller is expected to rename over it."""
+        dir_name, base_name = os.path.split(file_name)
+        highest = 0
+        for entry in os.listdir(dir_name or os.curdir):
+            if entry.startswith(base_name):
+                match = _BACKUP_SUFFIX_RE.match(entry, len(base_name))
+                if match:
+                    highest = max(highest, int(match.group(1)))
+        suffix = highest + 1
+        while True:
+            candidate = file_name + "." + str(suffix)
+            try:
+                os.close(os.open(candidate,
+                                 os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+                return candidate
+            except FileExistsError:
+                suffix += 1
 
     def __eq__(self, other):
         """Returns True if the data contained is equal. data_path and
            db_filename may be different."""
-        if type(other) != type(self):
+        if not isinstance(other, ConfigManagerData):
             return False
         return self.data == other.data
 
@@ -264,6 +426,20 @@ class ConfigManager:
                 bundy_config.PLUGIN_PATHS)))
         # store the logging 'module' name for easier reference
         self.log_module_name = self.log_config_data.get_module_spec().get_module_name()
+        # The handlers for the commands we know, called by handle_msg()
+        # with the command argument
+        self._command_handlers = {
+            ccsession.COMMAND_GET_COMMANDS_SPEC:
+                self.__handle_get_commands_spec,
+            ccsession.COMMAND_GET_STATISTICS_SPEC:
+                self.__handle_get_statistics_spec,
+            ccsession.COMMAND_GET_MODULE_SPEC: self.__handle_get_module_spec,
+            ccsession.COMMAND_GET_CONFIG: self.__handle_get_config,
+            ccsession.COMMAND_SET_CONFIG: self.__handle_set_config,
+            ccsession.COMMAND_MODULE_STOPPING: self.__handle_module_stopping,
+            ccsession.COMMAND_SHUTDOWN: self.__handle_shutdown,
+            ccsession.COMMAND_MODULE_SPEC: self.__handle_module_spec_command
+        }
 
     def check_logging_config(self, config):
         if self.log_module_name in config:
@@ -312,49 +488,42 @@ class ConfigManager:
                 # TODO: log error?
                 return {}
         else:
-            result = {}
-            for module in self.module_specs:
-                result[module] = self.module_specs[module].get_full_spec()
-            return result
+            return { name: spec.get_full_spec()
+                     for name, spec in self.module_specs.items() }
 
     def get_config_spec(self, name = None):
         """Returns a dict containing 'module_name': config_spec for
            all modules. If name is specified, only that module will
            be included"""
-        config_data = {}
         if name:
             if name in self.module_specs:
-                config_data[name] = self.module_specs[name].get_config_spec()
-        else:
-            for module_name in self.module_specs.keys():
-                config_data[module_name] = self.module_specs[module_name].get_config_spec()
-        return config_data
+                return { name: self.module_specs[name].get_config_spec() }
+            return {}
+        return { module_name: spec.get_config_spec()
+                 for module_name, spec in self.module_specs.items() }
 
     def get_commands_spec(self, name = None):
         """Returns a dict containing 'module_name': commands_spec for
            all modules. If name is specified, only that module will
            be included"""
-        commands = {}
         if name:
             if name in self.module_specs:
-                commands[name] = self.module_specs[name].get_commands_spec()
-        else:
-            for module_name in self.module_specs.keys():
-                commands[module_name] = self.module_specs[module_name].get_commands_spec()
-        return commands
+                return { name: self.module_specs[name].get_commands_spec() }
+            return {}
+        return { module_name: spec.get_commands_spec()
+                 for module_name, spec in self.module_specs.items() }
 
     def get_statistics_spec(self, name = None):
         """Returns a dict containing 'module_name': statistics_spec for
            all modules. If name is specified, only that module will
            be included"""
-        statistics = {}
         if name:
             if name in self.module_specs:
-                statistics[name] = self.module_specs[name].get_statistics_spec()
-        else:
-            for module_name in self.module_specs.keys():
-                statistics[module_name] = self.module_specs[module_name].get_statistics_spec()
-        return statistics
+                return { name:
+                         self.module_specs[name].get_statistics_spec() }
+            return {}
+        return { module_name: spec.get_statistics_spec()
+                 for module_name, spec in self.module_specs.items() }
 
     def read_config(self):
         """Read the current configuration from the file specificied at init()"""
@@ -372,15 +541,23 @@ class ConfigManager:
         """Write the current configuration to the file specificied at init()"""
         self.config.write_to_file()
 
+    def __handle_get_commands_spec(self, arg):
+        """Private function that handles the 'get_commands_spec' command"""
+        return ccsession.create_answer(0, self.get_commands_spec())
+
+    def __handle_get_statistics_spec(self, arg):
+        """Private function that handles the 'get_statistics_spec' command"""
+        return ccsession.create_answer(0, self.get_statistics_spec())
+
     def __handle_get_module_spec(self, cmd):
         """Private function that handles the 'get_module_spec' command"""
         answer = {}
-        if cmd != None:
-            if type(cmd) == dict:
+        if cmd is not None:
+            if isinstance(cmd, dict):
                 if 'module_name' in cmd and cmd['module_name'] != '':
                     module_name = cmd['module_name']
                     spec = self.get_module_spec(cmd['module_name'])
-                    if type(spec) != type({}):
+                    if not isinstance(spec, dict):
                         # this is a ModuleSpec object.  Extract the
                         # internal spec.
                         spec = spec.get_full_spec()
@@ -409,30 +586,85 @@ class ConfigManager:
 
     def __handle_get_config(self, cmd):
         """Private function that handles the 'get_config' command"""
-        if cmd != None:
-            if type(cmd) == dict:
+        if cmd is not None:
+            if isinstance(cmd, dict):
                 return self.__handle_get_config_dict(cmd)
             else:
                 return ccsession.create_answer(1, "Bad get_config command, argument not a dict")
         else:
             return ccsession.create_answer(0, self.config.data)
 
-    def __handle_set_config_module(self, module_name, cmd):
-        # the answer comes (or does not come) from the relevant module
-        # so we need a variable to see if we got it
-        answer = None
+    def __merge_module_config(self, module_name, cmd):
+        """Private function that merges the given new configuration into
+           the stored configuration of the given module, and returns
+           the resulting configuration of that module."""
         # todo: use api (and check the data against the definition?)
-        old_data = copy.deepcopy(self.config.data)
         conf_part = data.find_no_exc(self.config.data, module_name)
-        update_cmd = None
-        use_part = None
         if conf_part:
             data.merge(conf_part, cmd)
-            use_part = conf_part
+            return conf_part
         else:
             conf_part = data.set(self.config.data, module_name, {})
             data.merge(conf_part[module_name], cmd)
-            use_part = conf_part[module_name]
+            return conf_part[module_name]
+
+    def __check_virtual_module_config(self, module_name, update_cmd,
+                                      use_part):
+        """Private function that lets the checking function of the given
+           virtual module validate its new configuration. If it is
+           accepted, the update is announced to the module's group, but
+           no answer is waited for. Returns the answer for the update."""
+        try:
+            error = self.virtual_modules[module_name](use_part)
+            if error is None:
+                answer = ccsession.create_answer(0)
+                # OK, it is successful, send the notify, but don't wait
+                # for answer
+                seq = self.cc.group_sendmsg(update_cmd, module_name)
+            else:
+                answer = ccsession.create_answer(1, error)
+        # Make sure just a validating plugin don't kill the whole manager
+        except Exception as excp:
+            # Provide answer
+            answer = ccsession.create_answer(1, "Exception: " + str(excp))
+        return answer
+
+    def __recv_module_answer(self, module_name, seq):
+        """Private function that waits for the answer of the given module
+           to the configuration update sent with the given sequence
+           number. Returns the answer, which may be None."""
+        try:
+            # replace 'our' answer with that of the module
+            answer, env = self.cc.group_recvmsg(False, seq)
+        except bundy.cc.SessionTimeout:
+            answer = ccsession.create_answer(1, "Timeout waiting for answer from " + module_name)
+        except bundy.cc.SessionError as se:
+            logger.error(CFGMGR_BAD_UPDATE_RESPONSE_FROM_MODULE, module_name, se)
+            answer = ccsession.create_answer(1, "Unable to parse response from " + module_name + ": " + str(se))
+        return answer
+
+    def __save_config_data(self):
+        """Private function that returns a snapshot of the current
+           configuration data, to be passed to __restore_config_data()
+           if an update is rejected. A serialized snapshot is much
+           cheaper than a deep copy, and we rarely need to restore it;
+           only data that can't be serialized at all is copied."""
+        try:
+            return _json_dumps(self.config.data)
+        except (TypeError, ValueError):
+            return copy.deepcopy(self.config.data)
+
+    def __restore_config_data(self, old_data):
+        """Private function that rolls the configuration data back to
+           a snapshot taken by __save_config_data()."""
+        if isinstance(old_data, bytes):
+            self.config.data = _json_loads(old_data)
+        else:
+            self.config.data = old_data
+
+    def __handle_set_config_module(self, module_name, cmd):
+        old_data = self.__save_config_data()
+        use_part = self.__merge_module_config(module_name, cmd)
 
         # The command to send
         update_cmd = ccsession.create_command(ccsession.COMMAND_CONFIG_UPDATE,
@@ -447,71 +679,69 @@ class ConfigManager:
         # might have been committed already).
         if module_name in self.virtual_modules:
             # The module is virtual, so call it to get the answer
-            try:
-                error = self.virtual_modules[module_name](use_part)
-                if error is None:
-                    answer = ccsession.create_answer(0)
-                    # OK, it is successful, send the notify, but don't wait
-                    # for answer
-                    seq = self.cc.group_sendmsg(update_cmd, module_name)
-                else:
-                    answer = ccsession.create_answer(1, error)
-            # Make sure just a validating plugin don't kill the whole manager
-            except Exception as excp:
-                # Provide answer
-                answer = ccsession.create_answer(1, "Exception: " + str(excp))
+            answer = self.__check_virtual_module_config(module_name,
+                                                        update_cmd, use_part)
         else:
             # Real module, send it over the wire to it
             # send out changed info and wait for answer
             seq = self.cc.group_sendmsg(update_cmd, module_name)
-            try:
-                # replace 'our' answer with that of the module
-                answer, env = self.cc.group_recvmsg(False, seq)
-            except bundy.cc.SessionTimeout:
-                answer = ccsession.create_answer(1, "Timeout waiting for answer from " + module_name)
-            except bundy.cc.SessionError as se:
-                logger.error(CFGMGR_BAD_UPDATE_RESPONSE_FROM_MODULE, module_name, se)
-                answer = ccsession.create_answer(1, "Unable to parse response from " + module_name + ": " + str(se))
+            answer = self.__recv_module_answer(module_name, seq)
         if answer:
             rcode, val = ccsession.parse_answer(answer)
             if rcode == 0:
                 self.write_config()
             else:
-                self.config.data = old_data
+                self.__restore_config_data(old_data)
         return answer
 
     def __handle_set_config_all(self, cmd):
-        old_data = copy.deepcopy(self.config.data)
-        got_error = False
-        err_list = []
+        old_data = self.__save_config_data()
         # The format of the command is a dict with module->newconfig
-        # sets, so we simply call set_config_module for each of those
-        for module in cmd:
+        # sets. We first send the updates to all real modules, and only
+        # then wait for their answers, so the round trips overlap instead
+        # of being made one after the other. Virtual modules are checked
+        # right away. Each entry is [ module, seq, answer ].
+        results = []
+        for module, module_cmd in cmd.items():
             if module != "version":
-                answer = self.__handle_set_config_module(module, cmd[module])
-                if answer == None:
-                    got_error = True
-                    err_list.append("No answer message from " + module)
+                use_part = self.__merge_module_config(module, module_cmd)
+                update_cmd = ccsession.create_command(
+                    ccsession.COMMAND_CONFIG_UPDATE, use_part)
+                if module in self.virtual_modules:
+                    answer = self.__check_virtual_module_config(module,
+                                                                update_cmd,
+                                                                use_part)
+                    results.append([module, None, answer])
                 else:
-                    rcode, val = ccsession.parse_answer(answer)
-                    if rcode != 0:
-                        got_error = True
-                        err_list.append(val)
-        if not got_error:
+                    seq = self.cc.group_sendmsg(update_cmd, module)
+                    results.append([module, seq, None])
+        for result in results:
+            if result[1] is not None:
+                result[2] = self.__recv_module_answer(result[0], result[1])
+
+        errors = []
+        for module, seq, answer in results:
+            if answer is None:
+                errors.append("No answer message from " + module)
+            else:
+                rcode, val = ccsession.parse_answer(answer)
+                if rcode != 0:
+                    errors.append(val)
+        if not errors:
             # if Logging config is in there, update our config as well
             self.check_logging_config(cmd);
             self.write_config()
             return ccsession.create_answer(0)
         else:
             # TODO rollback changes that did get through, should we re-send update?
-            self.config.data = old_data
-            return ccsession.create_answer(1, " ".join(err_list))
+            self.__restore_config_data(old_data)
+            return ccsession.create_answer(1, " ".join(map(str, errors)))
 
     def __handle_set_config(self, cmd):
         """Private function that handles the 'set_config' command"""
         answer = None
 
-        if cmd == None:
+        if cmd is None:
             return ccsession.create_answer(1, "Wrong number of arguments")
         if len(cmd) == 2:
             answer = self.__handle_set_config_module(cmd[0], cmd[1])
@@ -535,6 +765,14 @@ class ConfigManager:
                                          spec.get_full_spec())
         return ccsession.create_answer(0)
 
+    def __handle_module_spec_command(self, arg):
+        """Private function that handles the 'module_spec' command,
+           where the argument is the full spec, still as a dict"""
+        try:
+            return self.__handle_module_spec(bundy.config.ModuleSpec(arg))
+        except bundy.config.ModuleSpecError as dde:
+            return ccsession.create_answer(1, "Error in data definition: " + str(dde))
+
     def __handle_module_stopping(self, arg):
         """Private function that handles a 'stopping' command;
            The argument is of the form { 'module_name': <name> }.
@@ -547,6 +785,11 @@ class ConfigManager:
         # This command is not expected to be answered
         return None
 
+    def __handle_shutdown(self, arg):
+        """Private function that handles the 'shutdown' command"""
+        self.running = False
+        return ccsession.create_answer(0)
+
     def _send_module_spec_to_cmdctl(self, module_name, spec):
         """Sends the given module spec for the given module name to Cmdctl.
            Parameters:
@@ -565,26 +808,9 @@ class ConfigManager:
         answer = {}
         cmd, arg = ccsession.parse_command(msg)
         if cmd:
-            if cmd == ccsession.COMMAND_GET_COMMANDS_SPEC:
-                answer = ccsession.create_answer(0, self.get_commands_spec())
-            elif cmd == ccsession.COMMAND_GET_STATISTICS_SPEC:
-                answer = ccsession.create_answer(0, self.get_statistics_spec())
-            elif cmd == ccsession.COMMAND_GET_MODULE_SPEC:
-                answer = self.__handle_get_module_spec(arg)
-            elif cmd == ccsession.COMMAND_GET_CONFIG:
-                answer = self.__handle_get_config(arg)
-            elif cmd == ccsession.COMMAND_SET_CONFIG:
-                answer = self.__handle_set_config(arg)
-            elif cmd == ccsession.COMMAND_MODULE_STOPPING:
-                answer = self.__handle_module_stopping(arg)
-            elif cmd == ccsession.COMMAND_SHUTDOWN:
-                self.running = False
-                answer = ccsession.create_answer(0)
-            elif cmd == ccsession.COMMAND_MODULE_SPEC:
-                try:
-                    answer = self.__handle_module_spec(bundy.config.ModuleSpec(arg))
-                except bundy.config.ModuleSpecError as dde:
-                    answer = ccsession.create_answer(1, "Error in data definition: " + str(dde))
+            handler = self._command_handlers.get(cmd)
+            if handler is not None:
+                answer = handler(arg)
             else:
                 answer = ccsession.create_answer(1, "Unknown command: " + str(cmd))
         else:
@@ -594,6 +820,10 @@ class ConfigManager:
     def run(self):
         """Runs the configuration manager."""
         self.running = True
+        # This loop is deliberately serial.  handle_msg() may itself send to
+        # and wait for answers from other modules on the same session, and
+        # Session.recvmsg() holds the session lock while blocking, so a
+        # separate receiver thread would starve (or deadlock) the handler.
         while self.running:
             # we just wait eternally for any command here, so disable
             # timeouts for this specific recv
@@ -18,7 +18,9 @@
 #
 
 import unittest
+import copy
 import os
+import bundy.config.cfgmgr
 from bundy.config.cfgmgr import *
 from bundy.config import config_data
 from unittest_fakesession import FakeModuleCCSession
@@ -78,6 +80,10 @@ class TestConfigManagerData(unittest.TestCase):
                    "Boss": { "some config": 1 },
                    "something": [ 1, 2, 3 ] }
         updated = ConfigManagerData.check_for_updates(config)
+        # The given data itself should not have been touched
+        self.assertEqual(2, config['version'])
+        self.assertIn('Boss', config)
+        self.assertNotIn('Init', config)
         config = { "version": config_data.BUNDY_CONFIG_DATA_VERSION,
                    "Init": { "some config": 1 },
                    "something": [ 1, 2, 3 ] }
@@ -117,6 +123,122 @@ class TestConfigManagerData(unittest.TestCase):
         self.assertEqual(self.config_manager_data, new_config)
         os.remove(output_file_name)
 
+    def test_write_to_file_unchanged(self):
+        file_name = self.writable_data_path + os.sep + \
+            "bundy-config-write-test"
+        cfd = ConfigManagerData(self.writable_data_path, file_name)
+        cfd.write_to_file()
+        inode = os.stat(file_name).st_ino
+        # Writing the same data again should leave the file alone
+        cfd.write_to_file()
+        self.assertEqual(inode, os.stat(file_name).st_ino)
+        # But changed data should be written
+        cfd.data['test'] = 1
+        cfd.write_to_file()
+        self.assertNotEqual(inode, os.stat(file_name).st_ino)
+        self.assertEqual(cfd, ConfigManagerData.read_from_file(
+                                self.writable_data_path, file_name))
+        # And so should the same data if the file got moved away
+        cfd.rename_config_file()
+        self.assertFalse(os.path.exists(file_name))
+        cfd.write_to_file()
+        self.assertTrue(os.path.exists(file_name))
+        os.remove(file_name)
+        os.remove(file_name + ".bak")
+
+    def test_write_to_file_dir_sync_failure(self):
+        # If only syncing the directory fails, the file has been written
+        # all the same, so that must not be reported as an error
+        file_name = self.writable_data_path + os.sep + \
+            "bundy-config-write-test"
+        cfd = ConfigManagerData(self.writable_data_path, file_name)
+        cfd.data['test'] = 1
+        logged = []
+        class FakeLogger:
+            def error(self, msg, *args):
+                logged.append(('error', msg))
+            def warn(self, msg, *args):
+                logged.append(('warn', msg))
+        orig_logger = bundy.config.cfgmgr.logger
+        orig_open = os.open
+        def fake_open(path, flags, *args, **kwargs):
+            if flags == os.O_RDONLY:
+                raise OSError("fake sync failure")
+            return orig_open(path, flags, *args, **kwargs)
+        bundy.config.cfgmgr.logger = FakeLogger()
+        os.open = fake_open
+        try:
+            cfd.write_to_file()
+        finally:
+            os.open = orig_open
+            bundy.config.cfgmgr.logger = orig_logger
+        self.assertEqual([('warn', CFGMGR_SYNC_CONFIG_DIRECTORY_FAILED)],
+                         logged)
+        self.assertEqual(cfd, ConfigManagerData.read_from_file(
+                                self.writable_data_path, file_name))
+        # and it's known to be there, so not written again
+        inode = os.stat(file_name).st_ino
+        cfd.write_to_file()
+        self.assertEqual(inode, os.stat(file_name).st_ino)
+        os.remove(file_name)
+
+    def test_write_to_file_big_numbers(self):
+        # Values the standard json module handles, but the fast JSON
+        # modules can't represent, must survive a round trip unchanged
+        file_name = self.writable_data_path + os.sep + \
+            "bundy-config-write-test"
+        cfd = ConfigManagerData(self.writable_data_path, file_name)
+        cfd.data['v'] = 2**64
+        cfd.data['w'] = [-2**63 - 1, 10**30]
+        cfd.data['x'] = float('inf')
+        cfd.write_to_file()
+        self.assertEqual(cfd, ConfigManagerData.read_from_file(
+                                self.writable_data_path, file_name))
+        os.remove(file_name)
+
+    def __check_json_backend(self, loads, dumps):
+        # Only one of the JSON backends is used, depending on what is
+        # installed, so run the reading and writing tests with the given
+        # ones explicitly
+        orig_loads = bundy.config.cfgmgr._json_loads
+        orig_dumps = bundy.config.cfgmgr._json_dumps
+        bundy.config.cfgmgr._json_loads = loads
+        bundy.config.cfgmgr._json_dumps = dumps
+        try:
+            self.test_read_from_file()
+            self.test_write_to_file_unchanged()
+            self.test_write_to_file_big_numbers()
+        finally:
+            bundy.config.cfgmgr._json_loads = orig_loads
+            bundy.config.cfgmgr._json_dumps = orig_dumps
+
+    def test_json_std(self):
+        self.__check_json_backend(bundy.config.cfgmgr._std_json_loads,
+                                  bundy.config.cfgmgr._std_json_dumps)
+
+    @unittest.skipIf(bundy.config.cfgmgr.orjson is None,
+                     "orjson is not installed")
+    def test_json_orjson(self):
+        self.__check_json_backend(bundy.config.cfgmgr._orjson_loads,
+                                  bundy.config.cfgmgr._orjson_dumps)
+
+    @unittest.skipIf(bundy.config.cfgmgr.simdjson is None,
+                     "pysimdjson is not installed")
+    def test_json_simdjson(self):
+        # pysimdjson only parses; check it reads what the standard module
+        # writes
+        self.__check_json_backend(bundy.config.cfgmgr._simdjson_loads,
+                                  bundy.config.cfgmgr._std_json_dumps)
+
+    def test_write_to_file_failure(self):
+        # If the file can't be put in place, the temporary file should
+        # not be left behind
+        before = os.listdir(self.writable_data_path)
+        self.config_manager_data.write_to_file(
+            self.writable_data_path + os.sep + "no-such-dir" + os.sep +
+            "bundy-config-write-test")
+        self.assertEqual(before, os.listdir(self.writable_data_path))
+
     def check_existence(self, files, should_exist=[], should_not_exist=[]):
         """Helper function for test_rename_config_file.
            Arguments:
@@ -171,6 +293,30 @@ class TestConfigManagerData(unittest.TestCase):
             if os.path.exists(filename):
                 os.remove(filename)
 
+    def test_rename_config_file_highest_suffix(self):
+        # With a gap in the existing backups, the new one gets a suffix
+        # above the highest one in use, rather than filling the gap.
+        # Names without a numeric suffix are ignored.
+        filenames = [ "bundy-config-rename-test",
+                      "bundy-config-rename-test.bak",
+                      "bundy-config-rename-test.bak.1",
+                      "bundy-config-rename-test.bak.3",
+                      "bundy-config-rename-test.bak.4",
+                      "bundy-config-rename-test.bak.x" ]
+
+        for filename in filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
+        for n in [0, 1, 3, 5]:
+            self.config_manager_data.write_to_file(filenames[n])
+
+        self.config_manager_data.rename_config_file(filenames[0])
+        self.check_existence(filenames, [1, 3, 4, 5], [0, 2])
+
+        for filename in filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
+
     def test_equality(self):
         # tests the __eq__ function. Equality is only defined
         # by equality of the .data element. If data_path or db_filename
@@ -469,7 +615,10 @@ class TestConfigManager(unittest.TestCase):
         self.assertEqual(len(self.fake_session.message_queue), 1)
         self.assertEqual({'command': [ 'config_update', {'test': 127}]},
                          self.fake_session.get_message(self.name, None))
-        # Config should not be updated due to the error
+        # Config should not be updated due to the error, neither in memory
+        # nor on disk
+        self.assertEqual(self.cm.config.data, { self.name: {'test': 126},
+                            'version': config_data.BUNDY_CONFIG_DATA_VERSION})
         self.cm.read_config()
         self.assertEqual(self.cm.config.data, { self.name: {'test': 126},
                             'version': config_data.BUNDY_CONFIG_DATA_VERSION})
@@ -501,6 +650,31 @@ class TestConfigManager(unittest.TestCase):
                                 },
                                 {'result': [0]})
 
+    def test_set_config_rollback_unusual_values(self):
+        # An accepted value the fast JSON modules can't represent must
+        # not break rolling back later updates
+        self.__test_handle_msg_update_config_helper({ "test": 2**64 })
+        # Nor must data that can't be serialized at all
+        self.cm.config.data['Other'] = { 'value': {1, 2} }
+        expected = copy.deepcopy(self.cm.config.data)
+
+        my_bad_answer = { 'result': [1, "bad config"] }
+        self.fake_session.group_sendmsg(my_bad_answer, "ConfigManager")
+        self._handle_msg_helper({ "command": [ "set_config",
+                                               [self.name, { "test": 1 }] ] },
+                                my_bad_answer )
+        self.fake_session.get_message(self.name, None)
+        self.assertEqual(expected, self.cm.config.data)
+
+        self.fake_session.group_sendmsg(my_bad_answer, "ConfigManager")
+        self._handle_msg_helper({ "command": [ "set_config",
+                                               [ { self.name: { "test": 1 } } ]
+                                             ] },
+                                { 'result': [1, "bad config"] })
+        self.fake_session.get_message(self.name, None)
+        self.assertEqual(expected, self.cm.config.data)
+        self.assertEqual(len(self.fake_session.message_queue), 0)
+
     def test_stopping_message(self):
         # Update the system by announcing this module
         self._handle_msg_helper({ "command":
@@ -525,6 +699,11 @@ class TestConfigManager(unittest.TestCase):
         self.assertEqual({'command': [ 'module_specification_update',
                                        ['Spec2', None] ] },
                          self.fake_session.get_message("Cmdctl", None))
+        # and the module should be gone from all the spec queries
+        self.assertEqual({}, self.cm.get_module_spec())
+        self.assertEqual({}, self.cm.get_config_spec())
+        self.assertEqual({}, self.cm.get_commands_spec())
+        self.assertEqual({}, self.cm.get_statistics_spec())
 
         # but if the 'stopping' module is either unknown or not running,
         # no follow-up message should be sent
@@ -647,6 +826,41 @@ class TestConfigManager(unittest.TestCase):
                          }, self.cm.config.data)
 
 
+    def test_set_config_all_multiple_modules(self):
+        # All updates should be sent out before any of the answers is
+        # waited for
+        calls = []
+        orig_sendmsg = self.fake_session.group_sendmsg
+        orig_recvmsg = self.fake_session.group_recvmsg
+        def sendmsg(msg, group, *args, **kwargs):
+            calls.append(('send', group))
+            return orig_sendmsg(msg, group, *args, **kwargs)
+        def recvmsg(nonblock=True, seq=None):
+            calls.append(('recv', seq))
+            return orig_recvmsg(nonblock, seq)
+        self.fake_session.group_sendmsg = sendmsg
+        self.fake_session.group_recvmsg = recvmsg
+
+        orig_sendmsg({ 'result': [ 0 ] }, "ConfigManager")
+        orig_sendmsg({ 'result': [ 1, "bad config" ] }, "ConfigManager")
+        answer = self.cm.handle_msg(ccsession.create_command(
+            ccsession.COMMAND_SET_CONFIG,
+            [{ "version": config_data.BUNDY_CONFIG_DATA_VERSION,
+               "Module1": { "value": 1 },
+               "Module2": { "value": 2 } }]))
+        self.assertEqual([('send', 'Module1'), ('send', 'Module2'),
+                          ('recv', 42), ('recv', 42)], calls)
+        self.assertEqual({ 'result': [ 1, "bad config" ] }, answer)
+        # Both updates were sent out, but the configuration is not changed
+        # because one of them got rejected
+        self.assertEqual({'command': [ 'config_update', { "value": 1 }]},
+                         self.fake_session.get_message("Module1", None))
+        self.assertEqual({'command': [ 'config_update', { "value": 2 }]},
+                         self.fake_session.get_message("Module2", None))
+        self.assertEqual(len(self.fake_session.message_queue), 0)
+        self.assertEqual({"version": config_data.BUNDY_CONFIG_DATA_VERSION},
+                         self.cm.config.data)
+
     def test_run(self):
         self.fake_session.group_sendmsg({ "command": [ "get_commands_spec" ] }, "ConfigManager")
         self.fake_session.group_sendmsg({ "command": [ "get_statistics_spec" ] }, "ConfigManager")
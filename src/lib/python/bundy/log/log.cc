@@ -516,9 +516,12 @@ objectToStr(PyObject* object, bool convert) {
 }
 
 // Generic function to output the logging message. Called by the real functions.
-template <class Function>
+// The enabled function is called with the debug level (0 if not a debug
+// message) and tells whether the message would be logged at all.
+template <class Function, class Enabled>
 PyObject*
-Logger_performOutput(Function function, PyObject* args, bool dbgLevel) {
+Logger_performOutput(Function function, Enabled enabled, PyObject* args,
+                     bool dbgLevel) {
     try {
         const Py_ssize_t number(PyObject_Length(args));
         if (number < 0) {
@@ -543,6 +546,12 @@ Logger_performOutput(Function function, PyObject* args, bool dbgLevel) {
             }
         }
 
+        // If the message would be dropped anyway, don't bother converting
+        // the message ID and all the parameters to strings.
+        if (!enabled(dbg)) {
+            Py_RETURN_NONE;
+        }
+
         // We create the logging message right now. If we fail to convert a
         // parameter to string, at least the part that we already did will
         // be output
@@ -584,6 +593,8 @@ PyObject*
 Logger_debug(PyObject* po_self, PyObject* args) {
     LoggerWrapper* self = static_cast<LoggerWrapper*>(po_self);
     return (Logger_performOutput(bind(&Logger::debug, self->logger_, _1, _2),
+                                 bind(&Logger::isDebugEnabled, self->logger_,
+                                      _1),
                                  args, true));
 }
 
@@ -591,6 +602,7 @@ PyObject*
 Logger_info(PyObject* po_self, PyObject* args) {
     LoggerWrapper* self = static_cast<LoggerWrapper*>(po_self);
     return (Logger_performOutput(bind(&Logger::info, self->logger_, _2),
+                                 bind(&Logger::isInfoEnabled, self->logger_),
                                  args, false));
 }
 
@@ -598,6 +610,7 @@ PyObject*
 Logger_warn(PyObject* po_self, PyObject* args) {
     LoggerWrapper* self = static_cast<LoggerWrapper*>(po_self);
     return (Logger_performOutput(bind(&Logger::warn, self->logger_, _2),
+                                 bind(&Logger::isWarnEnabled, self->logger_),
                                  args, false));
 }
 
@@ -605,6 +618,7 @@ PyObject*
 Logger_error(PyObject* po_self, PyObject* args) {
     LoggerWrapper* self = static_cast<LoggerWrapper*>(po_self);
     return (Logger_performOutput(bind(&Logger::error, self->logger_, _2),
+                                 bind(&Logger::isErrorEnabled, self->logger_),
                                  args, false));
 }
 
@@ -612,6 +626,7 @@ PyObject*
 Logger_fatal(PyObject* po_self, PyObject* args) {
     LoggerWrapper* self = static_cast<LoggerWrapper*>(po_self);
     return (Logger_performOutput(bind(&Logger::fatal, self->logger_, _2),
+                                 bind(&Logger::isFatalEnabled, self->logger_),
                                  args, false));
 }
 
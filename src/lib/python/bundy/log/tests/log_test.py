@@ -221,6 +221,13 @@ class Logger(unittest.TestCase):
                 raise ValueError("LogParam can't be converted to string")
         logger = bundy.log.Logger("child")
         self.assertRaises(ValueError, logger.info, self.TEST_MSG, LogParam())
+        # but nothing is converted if the message isn't logged anyway
+        logger.set_severity('WARN')
+        logger.info(self.TEST_MSG, LogParam())
+        logger.set_severity('DEBUG', 25)
+        logger.debug(50, self.TEST_MSG, LogParam())
+        self.assertRaises(ValueError, logger.debug, 25, self.TEST_MSG,
+                          LogParam())
 
 if __name__ == '__main__':
     unittest.main()
@@ -13,11 +13,51 @@
 # NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION
 # WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
+import errno
+import os
+import queue
 import threading
 import socket
+import socketserver
 import select
 
 SOCK_DATA = b'somedata'
+
+class _PollWrapper:
+    '''Gives select.poll the close() method of select.epoll, so that
+    serve_forever() can treat both the same way.'''
+    def __init__(self):
+        self.__poll = select.poll()
+
+    def register(self, fd, eventmask):
+        self.__poll.register(fd, eventmask)
+
+    def poll(self):
+        return self.__poll.poll()
+
+    def close(self):
+        pass
+
+# Whether NoPollMixIn wakes up serve_forever() through an eventfd rather
+# than a socketpair.  A variable so the tests can exercise both.
+_use_eventfd = hasattr(os, 'eventfd')
+
+def _new_epoll():
+    '''Returns a new epoll object and its event mask for readability.'''
+    return select.epoll(), select.EPOLLIN
+
+def _new_poll():
+    '''Returns a new poll based poller and its event mask for
+    readability.'''
+    return _PollWrapper(), select.POLLIN
+
+# Creates the poller used by serve_forever(): epoll where supported, poll
+# otherwise.
+if hasattr(select, 'epoll'):
+    _new_poller = _new_epoll
+else:
+    _new_poller = _new_poll
+
 class NoPollMixIn:
     '''This is a mix-in class to override the function serve_forever()
     and shutdown() in class socketserver.BaseServer.
@@ -27,8 +67,10 @@ class NoPollMixIn:
     "reduces the responsiveness to a shutdown request and wastes cpu at
     all other times."
 
-    This class fixes this problem by introducing internal message
-    passing via a separate socket. Note, however, that according to
+    This class fixes this problem by waking up serve_forever() through
+    an eventfd when shutdown() is called; where eventfd is not
+    available (it is Linux specific), internal message passing via a
+    separate socketpair is used instead. Note, however, that according to
     the module documentation serve_forever() and shutdown() are not
     categorized as functions that can be overridden via mix-ins.  So
     this mix-in class may not be compatible with future versions of
@@ -53,32 +95,56 @@ class NoPollMixIn:
     some other thread.
     '''
     def __init__(self):
-        self.__read_sock, self.__write_sock = socket.socketpair()
+        if _use_eventfd:
+            # A single eventfd is cheaper than a socketpair and needs
+            # only one descriptor.  The unbuffered file object owns it,
+            # so it is closed on garbage collection like the sockets
+            # even if server_close() is never called.
+            self.__wakeup = open(os.eventfd(0, os.EFD_CLOEXEC), 'rb',
+                                 buffering=0)
+            self.__write_sock = None
+        else:
+            self.__wakeup, self.__write_sock = socket.socketpair()
         self._is_shut_down = threading.Event()
 
     def serve_forever(self, poll_interval=None):
         ''' Overrides the serve_forever([poll_interval]) in class
         socketserver.BaseServer.
 
-        It uses a socketpair to wake up the select when shutdown() is
-        called in anther thread.  Note, parameter 'poll_interval' is
-        just used for interface compatibility; it's never used in this
-        function.
+        It uses an eventfd (or a socketpair where eventfd is not
+        available) to wake up the poller when shutdown() is called in
+        anther thread.  The listening socket and the wakeup descriptor
+        are registered once with epoll (or poll, where epoll is
+        not available) instead of rebuilding the select() fd sets on
+        every iteration.  Note, parameter 'poll_interval' is just used
+        for interface compatibility; it's never used in this function.
         '''
-        while True:
-            # block until the self.socket or self.__read_sock is readable
-            try:
-                r, w, e = select.select([self, self.__read_sock], [], [])
-            except select.error as err:
-                if err.args[0] == EINTR:
-                    continue
-                else:
-                    break
+        poller, readable = _new_poller()
+        # Level-triggered on purpose: _handle_request_noblock() accepts
+        # a single connection per wakeup, so any backlog must be
+        # reported again on the next poll.
+        poller.register(self.fileno(), readable)
+        wakeup_fd = self.__wakeup.fileno()
+        poller.register(wakeup_fd, readable)
+        try:
+            while True:
+                # block until the self.socket or the wakeup descriptor is
+                # readable
+                try:
+                    events = poller.poll()
+                except OSError as err:
+                    if err.errno == errno.EINTR:
+                        continue
+                    else:
+                        break
 
-            if self.__read_sock in r:
-                break
-            else:
-                self._handle_request_noblock();
+                fds = [fd for fd, event in events]
+                if wakeup_fd in fds:
+                    break
+                else:
+                    self._handle_request_noblock();
+        finally:
+            poller.close()
 
         self._is_shut_down.set()
 
@@ -88,5 +154,86 @@ class NoPollMixIn:
         Blocks until the loop has finished, the function should be called
         in another thread when serve_forever is running, or it will block.
         '''
-        self.__write_sock.send(SOCK_DATA) # make self.__read_sock readable.
+        # make the wakeup descriptor readable.
+        if self.__write_sock is None:
+            os.eventfd_write(self.__wakeup.fileno(), 1)
+        else:
+            self.__write_sock.send(SOCK_DATA)
         self._is_shut_down.wait()  # wait until the serve thread terminate
+
+    def server_close(self):
+        '''Closes the wakeup descriptor(s) along with the server socket.'''
+        super().server_close()
+        # may be called more than once
+        if self.__wakeup is not None:
+            self.__wakeup.close()
+            self.__wakeup = None
+        if self.__write_sock is not None:
+            self.__write_sock.close()
+            self.__write_sock = None
+
+class ThreadPoolMixIn(socketserver.ThreadingMixIn):
+    '''A replacement for socketserver.ThreadingMixIn that hands each
+    request to a fixed pool of worker threads instead of starting a new
+    thread per connection.
+
+    Like NoPollMixIn, the constructor of this mix-in must be called
+    explicitly in the derived class, and it must be placed before the
+    corresponding socketserver class:
+
+       class MyServer(NoPollMixIn, ThreadPoolMixIn,
+                      socketserver.TCPServer):
+           def __init__(...):
+               ...
+               NoPollMixIn.__init__(self)
+               ThreadPoolMixIn.__init__(self)
+               ...
+
+    Note that a worker is busy for as long as the handler runs, which for
+    persistent connections is until the client closes it.  So at most
+    max_workers connections are served at a time, and further ones wait
+    until a worker is free; servers whose clients keep idle connections
+    open should use ThreadingMixIn (or enough workers) instead.
+
+    The daemon_threads and block_on_close attributes of ThreadingMixIn
+    are honored: the workers are daemon threads if daemon_threads is
+    true, so they don't keep the process from exiting, and server_close()
+    waits for them to finish the requests at hand only if block_on_close
+    is true (the default).
+    '''
+    def __init__(self, max_workers=None):
+        '''max_workers: the maximum number of worker threads; if None,
+        as many as the concurrent.futures.ThreadPoolExecutor default.'''
+        if max_workers is None:
+            max_workers = min(32, (os.cpu_count() or 1) + 4)
+        self.__max_workers = max_workers
+        self.__requests = queue.SimpleQueue()
+        self._workers = []
+
+    def __work(self):
+        while True:
+            request = self.__requests.get()
+            if request is None:
+                break
+            self.process_request_thread(*request)
+
+    def process_request(self, request, client_address):
+        '''Queues the request for one of the worker threads, starting
+        another one if there are fewer than max_workers.'''
+        if len(self._workers) < self.__max_workers:
+            worker = threading.Thread(target=self.__work,
+                                      daemon=self.daemon_threads)
+            worker.start()
+            self._workers.append(worker)
+        self.__requests.put((request, client_address))
+
+    def server_close(self):
+        '''Closes the server socket and stops the workers, waiting for
+        them if block_on_close is true.'''
+        super().server_close()
+        workers, self._workers = self._workers, []
+        for worker in workers:
+            self.__requests.put(None)
+        if self.block_on_close:
+            for worker in workers:
+                worker.join()
@@ -13,49 +13,252 @@
 # NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION
 # WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
+import asyncio
 import unittest
-from bundy.util.socketserver_mixin import NoPollMixIn
+import bundy.util.socketserver_mixin
+from bundy.util.socketserver_mixin import NoPollMixIn, ThreadPoolMixIn
+import os
 import socketserver
+import struct
+import tempfile
 import threading
 import socket
-import time
 
 class MyHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.__buf = memoryview(bytearray(20))
+
     def handle(self):
-        data = self.request.recv(20)
-        self.request.send(data)
+        if self.request.family != socket.AF_UNIX:
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                                    1)
+        # keep echoing until the client closes the (pooled) connection;
+        # clients reset rather than close it (see set_client_options())
+        try:
+            n = self.request.recv_into(self.__buf)
+            while n:
+                self.request.sendall(self.__buf[:n])
+                n = self.request.recv_into(self.__buf)
+        except ConnectionResetError:
+            pass
 
 class MyServer(NoPollMixIn,
-               socketserver.ThreadingMixIn,
+               ThreadPoolMixIn,
                socketserver.TCPServer):
+    # leave room in the accept queue for the concurrent clients
+    request_queue_size = 128
 
     def __init__(self, server_addr, handler_class):
         NoPollMixIn.__init__(self)
+        ThreadPoolMixIn.__init__(self, 2)
         socketserver.TCPServer.__init__(self, server_addr, handler_class)
 
+class UnixMyServer(NoPollMixIn,
+                   ThreadPoolMixIn,
+                   socketserver.UnixStreamServer):
+
+    def __init__(self, server_addr, handler_class):
+        NoPollMixIn.__init__(self)
+        ThreadPoolMixIn.__init__(self, 2)
+        socketserver.UnixStreamServer.__init__(self, server_addr,
+                                               handler_class)
+
+# idle client connections, keyed by (ip, port), reused by
+# send_and_get_reply() instead of connecting anew for every message
+_connections = {}
+_connections_lock = threading.Lock()
+
+# receive buffer of send_and_get_reply(); the tests only call it from
+# the main thread
+_recv_buf = memoryview(bytearray(20))
+
+def set_client_options(sock):
+    '''Disables Nagle and makes close() send a RST, so that the many
+    short-lived client connections don't pile up in TIME_WAIT.'''
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                    struct.pack('ii', 1, 0))
+
+def get_connection(ip, port):
+    with _connections_lock:
+        idle = _connections.get((ip, port))
+        sock = idle.pop() if idle else None
+    if sock is None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        set_client_options(sock)
+        sock.connect((ip, port))
+    return sock
+
+def release_connection(ip, port, sock):
+    with _connections_lock:
+        _connections.setdefault((ip, port), []).append(sock)
+
 def send_and_get_reply(ip, port, msg):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.connect((ip, port))
-    sock.send(msg)
-    response = sock.recv(20)
-    sock.close()
+    sock = get_connection(ip, port)
+    sock.sendall(msg)
+    n = sock.recv_into(_recv_buf)
+    response = bytes(_recv_buf[:n])
+    release_connection(ip, port, sock)
+    return response
+
+def send_and_get_replies(ip, port, msgs):
+    '''Pipelines msgs over one connection, writing them all with a single
+    sendmsg(), and returns the concatenated replies.'''
+    sock = get_connection(ip, port)
+    total = sum(map(len, msgs))
+    sent = sock.sendmsg(msgs)
+    if sent < total:
+        sock.sendall(b''.join(msgs)[sent:])
+    response = bytearray()
+    while len(response) < total:
+        n = sock.recv_into(_recv_buf)
+        if n == 0:
+            break
+        response += _recv_buf[:n]
+    release_connection(ip, port, sock)
+    return bytes(response)
+
+def close_connections():
+    '''Closes all idle client connections, letting their handlers finish.'''
+    with _connections_lock:
+        for idle in _connections.values():
+            for sock in idle:
+                sock.close()
+        _connections.clear()
+
+async def ping(ip, port, msg):
+    reader, writer = await asyncio.open_connection(ip, port)
+    set_client_options(writer.get_extra_info('socket'))
+    writer.write(msg)
+    await writer.drain()
+    response = await reader.readexactly(len(msg))
+    writer.close()
+    await writer.wait_closed()
     return response
 
+async def ping_all(ip, port, msg, count):
+    return await asyncio.gather(*[ping(ip, port, msg) for i in range(count)])
+
 class TestNoPollMixIn(unittest.TestCase):
+    def setUp(self):
+        self.__orig_new_poller = bundy.util.socketserver_mixin._new_poller
+        self.__orig_use_eventfd = bundy.util.socketserver_mixin._use_eventfd
+
+    def tearDown(self):
+        bundy.util.socketserver_mixin._new_poller = self.__orig_new_poller
+        bundy.util.socketserver_mixin._use_eventfd = self.__orig_use_eventfd
+
+    def __start_server(self, server):
+        '''Runs server.serve_forever() in a thread.  The server is shut
+        down and closed when the test ends, even if it fails, so its
+        worker threads can't keep the interpreter from exiting.'''
+        server_thread = threading.Thread(target=server.serve_forever,
+                                         daemon=True)
+        server_thread.start()
+        self.addCleanup(self.__stop_server, server, server_thread)
+        return server_thread
+
+    def __stop_server(self, server, server_thread):
+        if not server._is_shut_down.is_set():
+            server.shutdown()
+        server.server_close()
+        server_thread.join(1)
+
+    def test_serve_forever_poll(self):
+        # Force the select.poll() and socketpair fallbacks used where epoll
+        # and eventfd are unavailable
+        bundy.util.socketserver_mixin._new_poller = \
+            bundy.util.socketserver_mixin._new_poll
+        bundy.util.socketserver_mixin._use_eventfd = False
+        self.test_serve_forever()
+
     def test_serve_forever(self):
-        # use port 0 to select an arbitrary unused port.
+        # use port 0 to select an arbitrary unused port.  The constructor
+        # binds and listens synchronously, so clients may connect as soon
+        # as it returns, even before serve_forever() runs.
         server = MyServer(('127.0.0.1', 0), MyHandler)
         ip, port = server.server_address
-        server_thread = threading.Thread(target=server.serve_forever)
-        server_thread.start()
+        server_thread = self.__start_server(server)
+        # cleanups run in reverse order: the pooled connections are closed
+        # first, letting their handlers return before the pool is joined
+        self.addCleanup(close_connections)
 
         msg = b'senddata'
         self.assertEqual(msg, send_and_get_reply(ip, port, msg))
+        # the second message goes over the same connection
+        self.assertEqual(msg, send_and_get_reply(ip, port, msg))
+        self.assertEqual(1, len(_connections[(ip, port)]))
+        # and several pipelined ones in one write
+        self.assertEqual(msg * 3,
+                         send_and_get_replies(ip, port, [msg, msg, msg]))
+        self.assertEqual(1, len(_connections[(ip, port)]))
+        # many concurrent clients, all of which must be answered
+        self.assertEqual([msg] * 100,
+                         asyncio.run(ping_all(ip, port, msg, 100)))
         self.assertTrue(server_thread.is_alive())
+        close_connections()
 
         self.assertFalse(server._is_shut_down.is_set())
         server.shutdown() # Now shutdown the server
         self.assertTrue(server._is_shut_down.is_set())
+        # no more than the configured number of workers were started
+        workers = server._workers
+        self.assertEqual(2, len(workers))
+        self.assertFalse(any(worker.daemon for worker in workers))
+        server.server_close()
+        # the workers have been stopped and joined
+        self.assertFalse(any(worker.is_alive() for worker in workers))
+        # closing again must not touch the (possibly reused) descriptors
+        server.server_close()
+        server_thread.join(1)
+        self.assertFalse(server_thread.is_alive())
+
+    def test_server_close_nonblocking(self):
+        # With daemon_threads and without block_on_close, a worker stuck
+        # on an idle connection delays neither server_close() nor the
+        # exit of the process
+        server = MyServer(('127.0.0.1', 0), MyHandler)
+        server.daemon_threads = True
+        server.block_on_close = False
+        ip, port = server.server_address
+        self.__start_server(server)
+        sock = socket.create_connection((ip, port))
+        self.addCleanup(sock.close)
+        sock.sendall(b'senddata')
+        self.assertEqual(b'senddata', sock.recv(20))
+
+        workers = server._workers
+        self.assertEqual(1, len(workers))
+        self.assertTrue(workers[0].daemon)
+        server.shutdown()
+        server.server_close()
+        # the handler is still waiting for the client
+        self.assertTrue(workers[0].is_alive())
+
+    def test_serve_forever_unix(self):
+        # the same echo over a unix domain socket, as used by xfrout,
+        # which keeps the TCP stack out of the measurement
+        sock_dir = tempfile.mkdtemp()
+        self.addCleanup(os.rmdir, sock_dir)
+        sock_file = os.path.join(sock_dir, 'mixin_test.sock')
+        server = UnixMyServer(sock_file, MyHandler)
+        self.addCleanup(os.unlink, sock_file)
+        server_thread = self.__start_server(server)
+
+        msg = b'senddata'
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(sock.close)
+        sock.connect(sock_file)
+        for i in range(3):
+            sock.sendall(msg)
+            self.assertEqual(msg, sock.recv(20))
+        sock.close()
+
+        server.shutdown()
+        self.assertTrue(server._is_shut_down.is_set())
+        server.server_close()
+        server_thread.join(1)
+        self.assertFalse(server_thread.is_alive())
 
 if __name__== "__main__":
     unittest.main()